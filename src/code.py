@@ -20,31 +20,35 @@
 
 
 import struct
+import time
 
 import board
 import busio
 from microcontroller import Pin
 
 from c0microsd.interface import C0microSDSignaloidSoCInterfaceSDSPI
-from signaloid.circuitpython.plot_wrapper import plot
 from signaloid.distributional.distributional import DistributionalValue
-from signaloid.distributional_information_plotting.plot_histogram_dirac_deltas import \
-    PlotData
 
 
 class APP_CONFIG:
     """Application configuration.
 
     This class contains the configuration for the application, including the
-    pin assignments for the SPI interface and the SPI baudrate.
+    pin assignments for the SPI interface and the SPI baudrate. The device is
+    initialized at SPI_BAUDRATE. Unless SPI_BAUDRATE_NEGOTIATION is disabled,
+    the faster rates in SPI_BAUDRATE_LADDER are then tried in order, and the
+    first one that passes a MOSI/MISO round trip check is kept.
     """
     PIN_MOSI: Pin = board.SD_MOSI
     PIN_MISO: Pin = board.SD_MISO
     PIN_CLK: Pin = board.SD_SCK
     PIN_SD_CS: Pin = board.SD_CS
     SPI_BAUDRATE: int = 5000000
+    SPI_BAUDRATE_NEGOTIATION: bool = True
+    SPI_BAUDRATE_LADDER: tuple[int, ...] = (25000000, 20000000, 10000000)
     SPI_PHASE: int = 0
     SPI_POLARITY: int = 0
+    SPI_LOCK_TIMEOUT: float = 1.0
     SD_REPEAT_TIMEOUT: int = 1000
     DOUBLE_PRECISION: bool = False
     PLOTTING_RESOLUTION: int = 32
@@ -58,21 +62,103 @@ class Device:
             MOSI=APP_CONFIG.PIN_MOSI,
             MISO=APP_CONFIG.PIN_MISO,
         )
+        self.configure_spi(APP_CONFIG.SPI_BAUDRATE)
+
+        # Initialize the C0-microSD interface
+        self.C0_microSD: C0microSDSignaloidSoCInterfaceSDSPI = C0microSDSignaloidSoCInterfaceSDSPI(
+            spi=self.spi,
+            cs_pin=APP_CONFIG.PIN_SD_CS,
+            timeout=APP_CONFIG.SD_REPEAT_TIMEOUT
+        )
+
+    def configure_spi(self, baudrate: int) -> None:
+        """
+        Reconfigure the SPI bus to the given baudrate.
+
+        :param baudrate: The SPI clock frequency in Hz
+
+        :raises RuntimeError: when the SPI bus lock cannot be acquired within
+            APP_CONFIG.SPI_LOCK_TIMEOUT seconds
+        """
+        # Yield between attempts instead of spinning on the lock, and give up
+        # if it is never released
+        deadline = time.monotonic() + APP_CONFIG.SPI_LOCK_TIMEOUT
         while not self.spi.try_lock():
-            pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(
+                    "Error: Timed out while waiting for the SPI bus lock."
+                )
+            time.sleep(0)
         self.spi.configure(
-            baudrate=APP_CONFIG.SPI_BAUDRATE,
+            baudrate=baudrate,
             phase=APP_CONFIG.SPI_PHASE,
             polarity=APP_CONFIG.SPI_POLARITY
         )
         self.spi.unlock()
 
-        # Initialize the C0-microSD interface
-        self.C0_microSD: C0microSDSignaloidSoCInterfaceSDSPI = C0microSDSignaloidSoCInterfaceSDSPI(
-            spi=self.spi,
-            cs_pin=APP_CONFIG.PIN_SD_CS,
-            timeout=APP_CONFIG.SD_REPEAT_TIMEOUT
+    def round_trip(self, mosi_buffer: bytearray) -> bytes:
+        """
+        Write the MOSI buffer, run an addition, and read back the MISO buffer.
+
+        :param mosi_buffer: The MOSI buffer to send
+
+        :return: The 4-byte length header and the result bytes it covers
+        """
+        self.C0_microSD.write_signaloid_soc_MOSI_buffer(mosi_buffer)
+        result_buffer = self.C0_microSD.calculate_command(kCalculateAddition)
+
+        # Only the header and the returned bytes are defined, anything after
+        # them may be left over from an earlier command
+        returned_bytes = struct.unpack_from("I", result_buffer, 0)[0]
+        return result_buffer[:4 + returned_bytes]
+
+    def negotiate_spi_baudrate(self, mosi_buffer: bytearray) -> int:
+        """
+        Raise the SPI clock to the fastest rate the C0-microSD handles.
+
+        A round trip with fixed probe parameters is first run at
+        APP_CONFIG.SPI_BAUDRATE, and its returned result is used as the
+        reference. Each rate in APP_CONFIG.SPI_BAUDRATE_LADDER is then tried
+        in order, and the first one whose round trip returns the same result
+        is kept. If none does, the bus is restored to APP_CONFIG.SPI_BAUDRATE.
+
+        :param mosi_buffer: The MOSI buffer to pack the probe parameters in
+
+        :return: The selected SPI baudrate
+        """
+        pack_floats_into(
+            mosi_buffer,
+            kBaudrateProbeParameters,
+            double_precision=APP_CONFIG.DOUBLE_PRECISION
         )
+        try:
+            reference_result = self.round_trip(mosi_buffer)
+        except Exception as e:
+            print(f"Warning: Keeping the default SPI baudrate: {e}")
+            return APP_CONFIG.SPI_BAUDRATE
+
+        for baudrate in APP_CONFIG.SPI_BAUDRATE_LADDER:
+            try:
+                self.configure_spi(baudrate)
+                if self.round_trip(mosi_buffer) == reference_result:
+                    return baudrate
+                print(
+                    f"Warning: SPI baudrate {baudrate // 1000000} MHz "
+                    "returned a different result."
+                )
+            except Exception as e:
+                print(
+                    f"Warning: SPI baudrate {baudrate // 1000000} MHz "
+                    f"failed: {e}"
+                )
+
+        # No faster rate was reliable, fall back to the initialization rate
+        try:
+            self.configure_spi(APP_CONFIG.SPI_BAUDRATE)
+            self.C0_microSD.get_status()
+        except Exception as e:
+            print(f"Warning: Could not restore the default SPI baudrate: {e}")
+        return APP_CONFIG.SPI_BAUDRATE
 
 
 kCalculateNoCommand = 0
@@ -88,27 +174,43 @@ calculation_commands = {
     "div": kCalculateDivision,
 }
 
+# Parameters of the addition used to verify SPI baudrates
+kBaudrateProbeParameters = [1.5, 2.5, 3.5, 4.5]
 
-def pack_floats(floats: list[float], size: int, double_precision: bool = True) -> bytes:
+# Console spacing, built once instead of on every print
+kClearScreen = "\n" * 10
+kCommandSeparator = "\n" * 2
+
+
+def pack_floats_into(buffer: bytearray, floats: list[float], double_precision: bool = True) -> None:
     """
-    Pack a list of floats to a zero-padded bytes buffer of length size
+    Pack a list of floats to the start of an existing buffer, leaving the rest
+    of the buffer untouched
 
+    :param buffer: Target buffer
     :param floats: List of floats to be packed
-    :param size: Size of target buffer
     :param double_precision: If the floats are in double precision representation
-
-    :return: The padded bytes buffer
     """
     format_str = f"{len(floats)}{'d' if double_precision else 'f'}"
-    buffer = struct.pack(format_str, *floats)
-
-    # Pad the buffer with zeros
-    if len(buffer) < size:
-        buffer += bytes(size - len(buffer))
-    elif len(buffer) > size:
+    if struct.calcsize(format_str) > len(buffer):
         raise ValueError(
-            f"Buffer length exceeds {size} bytes after packing floats."
+            f"Buffer length exceeds {len(buffer)} bytes after packing floats."
         )
+    struct.pack_into(format_str, buffer, 0, *floats)
+
+
+def pack_floats(floats: list[float], size: int, double_precision: bool = True) -> bytearray:
+    """
+    Pack a list of floats to a zero-padded bytearray of length size
+
+    :param floats: List of floats to be packed
+    :param size: Size of target buffer
+    :param double_precision: If the floats are in double precision representation
+
+    :return: The padded bytearray
+    """
+    buffer = bytearray(size)
+    pack_floats_into(buffer, floats, double_precision=double_precision)
     return buffer
 
 
@@ -139,33 +241,46 @@ def unpack_floats(byte_buffer: bytes, count: int, double_precision: bool = True)
 
     # Unpack the 'count' number of floats
     format_string = f"{count}{'d' if double_precision else 'f'}"
-    floats = struct.unpack(format_string, byte_buffer[:expected_size])
+    floats = struct.unpack_from(format_string, byte_buffer, 0)
 
     return list(floats)
 
 
-def pack_unsigned_integers(uint: list[int], size: int) -> bytes:
+def pack_unsigned_integers(uint: list[int], size: int) -> bytearray:
     """
-    Pack a list of unsigned integers to a zero-padded bytes.
-    buffer of length size
+    Pack a list of unsigned integers to a zero-padded bytearray
+    of length size
 
     :param uint: List of unsigned integers to be packed
     :param size: Size of target buffer
 
-    :return: The padded bytes buffer
+    :return: The padded bytearray
     """
-    buffer = struct.pack(f"<{len(uint)}I", *uint)
-
-    # Pad the buffer with zeros
-    if len(buffer) < size:
-        buffer += bytes(size - len(buffer))
-    elif len(buffer) > size:
+    format_str = f"<{len(uint)}I"
+    if struct.calcsize(format_str) > size:
         raise ValueError(
             f"Buffer length exceeds {size} bytes after packing doubles."
         )
+
+    # Pack directly into a zero-initialized buffer of the target size
+    buffer = bytearray(size)
+    struct.pack_into(format_str, buffer, 0, *uint)
     return buffer
 
 
+# Powers of ten for the negative orders most commonly given as input, indexed
+# by the number of decimal places
+kPowersOfTen = (
+    1.0, 1e-1, 1e-2, 1e-3, 1e-4, 1e-5, 1e-6,
+    1e-7, 1e-8, 1e-9, 1e-10, 1e-11, 1e-12,
+)
+
+# Cache of previously parsed tolerance values, bounded so that one-off inputs
+# cannot grow it without limit
+kToleranceCacheSize = 64
+tolerance_cache: dict[str, tuple[float, float]] = {}
+
+
 def parse_tolerance_value(value_with_uncertainty: str) -> tuple[float, float]:
     """
     This function parses a string following the concise form of uncertainty
@@ -182,48 +297,56 @@ def parse_tolerance_value(value_with_uncertainty: str) -> tuple[float, float]:
     :return: minimum and maximum values of the uniform distribution
     """
 
-    # Split the value and the uncertainty part
-    if '(' not in value_with_uncertainty or ')' not in value_with_uncertainty:
+    cached = tolerance_cache.get(value_with_uncertainty)
+    if cached is not None:
+        return cached
+
+    # Locate the uncertainty part
+    lpar = value_with_uncertainty.rfind('(')
+    rpar = value_with_uncertainty.rfind(')')
+    if lpar < 0 or rpar < lpar or rpar != len(value_with_uncertainty) - 1:
         raise ValueError(
             "Invalid format. Please provide value in the format 'X.Y(Z)'")
 
     # Extract the main value and the uncertainty
-    value_str, uncertainty_str = value_with_uncertainty.split('(')
-    uncertainty_str = uncertainty_str.strip(')')
+    value_str = value_with_uncertainty[:lpar]
+    uncertainty_str = value_with_uncertainty[lpar + 1:rpar].strip(')')
 
     # Find smallest order
-    if "." in value_str:
-        # Split at the decimal point
-        _, decimal_part = value_str.split(".")
-        order = -(len(decimal_part))
-    else:
-        order = 0
+    dot = value_str.find(".")
+    order = -(len(value_str) - dot - 1) if dot >= 0 else 0
 
     # Convert to appropriate types
     value = float(value_str)
     uncertainty = int(uncertainty_str)
 
     # Calculate minimum and maximum values
-    min_value = value - (uncertainty * (10 ** order))
-    max_value = value + (uncertainty * (10 ** order))
+    scale = kPowersOfTen[-order] if -order < len(kPowersOfTen) else 10.0 ** order
+    delta = uncertainty * scale
+    min_value = value - delta
+    max_value = value + delta
 
-    return (min_value, max_value)
+    result = (min_value, max_value)
+    if len(tolerance_cache) < kToleranceCacheSize:
+        tolerance_cache[value_with_uncertainty] = result
+
+    return result
 
 
 def main():
     # Clear the screen
-    print("\n"*10)
-
-    # Initialize the device
-    d = Device()
+    print(kClearScreen)
 
     # Get the default display root group (the terminal), so that we can
     # restore it later
     default_display_root_group = board.DISPLAY.root_group
 
-    # Try to get the status of the C0-microSD, if it is not in SoC mode, then
-    # raise an exception and exit the program
+    # Initialize the device and try to get the status of the C0-microSD, if
+    # either fails or it is not in SoC mode, then raise an exception and exit
+    # the program
     try:
+        d = Device()
+
         d.C0_microSD.get_status()
         print(d.C0_microSD)
 
@@ -236,10 +359,25 @@ def main():
         print(e)
         return
 
+    # Only load the plotting libraries once the C0-microSD is known to be
+    # usable, so that a failed start does not pay for them
+    from signaloid.circuitpython.plot_wrapper import plot
+    from signaloid.distributional_information_plotting.plot_histogram_dirac_deltas import \
+        PlotData
+
+    # Every command sends exactly four parameters at the start of the MOSI
+    # buffer, so allocate the zero-padded buffer once and overwrite only its
+    # head on each command
+    mosi_buffer = bytearray(d.C0_microSD.MOSI_BUFFER_SIZE_BYTES)
+
+    if APP_CONFIG.SPI_BAUDRATE_NEGOTIATION:
+        baudrate = d.negotiate_spi_baudrate(mosi_buffer)
+        print(f"SPI baudrate: {baudrate // 1000000} MHz")
+
     # Main loop: Continue to ask for commands until the user enters 'q'
     while True:
         try:
-            print("\n"*2)
+            print(kCommandSeparator)
 
             # Ask the user for a command
             command = input("Give me a command...\n")
@@ -250,23 +388,22 @@ def main():
             arg_b_min, arg_b_max = parse_tolerance_value(args_argument_b)
 
             print("Sending parameters to C0-microSD...")
-            data = pack_floats(
+            pack_floats_into(
+                mosi_buffer,
                 [arg_a_min, arg_a_max, arg_b_min, arg_b_max],
-                d.C0_microSD.MOSI_BUFFER_SIZE_BYTES,
                 double_precision=APP_CONFIG.DOUBLE_PRECISION
             )
-            d.C0_microSD.write_signaloid_soc_MOSI_buffer(data)
+            d.C0_microSD.write_signaloid_soc_MOSI_buffer(mosi_buffer)
 
             # Calculate result
             result_buffer = d.C0_microSD.calculate_command(
                 calculation_commands[args_command])
 
             # Interpret and remove the first 4 bytes as an unsigned integer
-            returned_bytes = struct.unpack("I", result_buffer[:4])[0]
+            returned_bytes = struct.unpack_from("I", result_buffer, 0)[0]
 
             # Keep only needed bytes in buffer
-            result_buffer = result_buffer[4:]
-            result_buffer = result_buffer[:returned_bytes]
+            result_buffer = result_buffer[4:4 + returned_bytes]
 
             print("Parsing distribution.")
             distribution = DistributionalValue.parse(